@@ -1,5 +1,7 @@
 from .core import (
     DenseFeat,
+    EmbeddingMatrix,
+    EmbeddingSlice,
     SequencePoolingLayer,
     SparseFeat,
     VarLenSparseFeat,
@@ -7,28 +9,34 @@ from .core import (
     combined_dnn_input,
     concat_fun,
     create_embedding_matrix,
+    embedding_list_lookup,
     embedding_lookup,
     get_dense_input,
     get_feature_names,
     get_varlen_pooling_list,
     maxlen_lookup,
     varlen_embedding_lookup,
+    varlen_pooling_lookup,
 )
 
 __all__ = [
     "SequencePoolingLayer",
     "DenseFeat",
+    "EmbeddingMatrix",
+    "EmbeddingSlice",
     "SparseFeat",
     "VarLenSparseFeat",
     "build_input_features",
     "create_embedding_matrix",
     "get_varlen_pooling_list",
     "varlen_embedding_lookup",
+    "varlen_pooling_lookup",
     "combined_dnn_input",
     "get_dense_input",
     "get_feature_names",
     "get_varlen_pooling_list",
     "concat_fun",
+    "embedding_list_lookup",
     "embedding_lookup",
     "maxlen_lookup",
 ]
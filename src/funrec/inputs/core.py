@@ -2,11 +2,10 @@
 
 
 from collections import OrderedDict, defaultdict
-from itertools import chain
 
-import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from funlog import getLogger
 
 from funrec.layers.sequence import SequencePoolingLayer
@@ -139,20 +138,13 @@ def build_input_features(feature_columns):
 
 
 def combined_dnn_input(sparse_embedding_list, dense_value_list):
-    if len(sparse_embedding_list) > 0 and len(dense_value_list) > 0:
-        sparse_dnn_input = torch.flatten(
-            torch.cat(sparse_embedding_list, dim=-1), start_dim=1
-        )
-        dense_dnn_input = torch.flatten(
-            torch.cat(dense_value_list, dim=-1), start_dim=1
-        )
-        return concat_fun([sparse_dnn_input, dense_dnn_input])
-    elif len(sparse_embedding_list) > 0:
-        return torch.flatten(torch.cat(sparse_embedding_list, dim=-1), start_dim=1)
-    elif len(dense_value_list) > 0:
-        return torch.flatten(torch.cat(dense_value_list, dim=-1), start_dim=1)
-    else:
+    if len(sparse_embedding_list) == 0 and len(dense_value_list) == 0:
         raise NotImplementedError
+    # flatten every (batch_size, ..., dim) input and concatenate them once
+    return concat_fun(
+        [x.reshape(x.size(0), -1) for x in [*sparse_embedding_list, *dense_value_list]],
+        axis=1,
+    )
 
 
 def get_varlen_pooling_list(
@@ -162,21 +154,15 @@ def get_varlen_pooling_list(
     for feat in varlen_sparse_feature_columns:
         seq_emb = embedding_dict[feat.name]
         if feat.length_name is None:
-            seq_mask = (
-                features[
-                    :, feature_index[feat.name][0] : feature_index[feat.name][1]
-                ].long()
-                != 0
-            )
+            start, end = feature_index[feat.name]
+            seq_mask = features[:, start:end].long() != 0
 
             emb = SequencePoolingLayer(
                 mode=feat.combiner, supports_masking=True, device=device
             )([seq_emb, seq_mask])
         else:
-            seq_length = features[
-                :,
-                feature_index[feat.length_name][0] : feature_index[feat.length_name][1],
-            ].long()
+            start, end = feature_index[feat.length_name]
+            seq_length = features[:, start:end].long()
             emb = SequencePoolingLayer(
                 mode=feat.combiner, supports_masking=False, device=device
             )([seq_emb, seq_length])
@@ -184,11 +170,165 @@ def get_varlen_pooling_list(
     return varlen_sparse_embedding_list
 
 
+def _check_ids(input, num_embeddings):
+    # The ids of a feature are offset into a table shared with other features, so an
+    # id past its vocabulary would read another feature's rows instead of raising
+    if ((input < 0) | (input >= num_embeddings)).any():
+        raise IndexError("index out of range in self")
+
+
+class EmbeddingSlice(object):
+    """Embedding of one feature, viewed as the rows ``[start, start + num_embeddings)``
+    of a table shared by all the features with the same embedding dim. The table is
+    a plain reference, it is registered once on the owning EmbeddingMatrix.
+    """
+
+    def __init__(
+        self,
+        table: nn.Embedding,
+        start: int,
+        num_embeddings: int,
+        check_bounds: bool = False,
+    ):
+        self.table = table
+        self.start = start
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = table.embedding_dim
+        self.check_bounds = check_bounds
+
+    @property
+    def weight(self):
+        return self.table.weight[self.start : self.start + self.num_embeddings]
+
+    def __call__(self, input):
+        if self.check_bounds:
+            _check_ids(input, self.num_embeddings)
+        return self.table(input + self.start)
+
+
+class EmbeddingMatrix(nn.Module):
+    """{embedding_name: EmbeddingSlice} of the sparse features.
+
+    Each merged table is registered once under ``tables``, keyed by its embedding
+    dim, and ``slices`` maps embedding_name to (table key, offset, size). Slices are
+    built on access, so they always point at the table of the module (or of the
+    DataParallel replica) they are read from.
+
+    ``slices`` is saved as the extra state of the module. Loading a state dict with
+    another layout copies the rows by embedding_name, and state dicts with one
+    ``<embedding_name>.weight`` per feature (before the tables were merged) still
+    load.
+
+    Ids are not checked against the vocabulary of their feature: an out of range id
+    reads the rows of the next feature in the table. Set ``check_bounds`` to raise
+    IndexError instead, at the cost of one more reduction per lookup.
+    """
+
+    def __init__(self, tables, slices, check_bounds=False):
+        super(EmbeddingMatrix, self).__init__()
+        self.tables = nn.ModuleDict(tables)
+        self.slices = OrderedDict(slices)
+        self.check_bounds = check_bounds
+
+    def __getitem__(self, embedding_name):
+        key, start, size = self.slices[embedding_name]
+        return EmbeddingSlice(self.tables[key], start, size, self.check_bounds)
+
+    def __len__(self):
+        return len(self.slices)
+
+    def __iter__(self):
+        return iter(self.slices)
+
+    def __contains__(self, embedding_name):
+        return embedding_name in self.slices
+
+    def keys(self):
+        return self.slices.keys()
+
+    def values(self):
+        return [self[embedding_name] for embedding_name in self.slices]
+
+    def items(self):
+        return [
+            (embedding_name, self[embedding_name]) for embedding_name in self.slices
+        ]
+
+    def get_extra_state(self):
+        return {"slices": dict(self.slices)}
+
+    def set_extra_state(self, state):
+        # The rows are already remapped to the current layout in _load_from_state_dict
+        pass
+
+    def _load_from_state_dict(
+        self,
+        state_dict,
+        prefix,
+        local_metadata,
+        strict,
+        missing_keys,
+        unexpected_keys,
+        error_msgs,
+    ):
+        extra_state_key = prefix + "_extra_state"
+        # {embedding_name: saved rows} when the saved layout differs from the current
+        saved_rows = {}
+        if extra_state_key in state_dict:
+            saved_slices = state_dict[extra_state_key]["slices"]
+            if saved_slices != self.slices:
+                for embedding_name, (key, start, size) in saved_slices.items():
+                    table_key = prefix + "tables." + key + ".weight"
+                    if table_key in state_dict:
+                        saved_rows[embedding_name] = state_dict[table_key][
+                            start : start + size
+                        ]
+        else:
+            # Saved before the tables were merged, with one ``<embedding_name>.weight``
+            # per feature
+            for embedding_name in self.slices:
+                legacy_key = prefix + embedding_name + ".weight"
+                if legacy_key in state_dict:
+                    saved_rows[embedding_name] = state_dict.pop(legacy_key)
+            state_dict[extra_state_key] = self.get_extra_state()
+        if saved_rows:
+            weights = OrderedDict(
+                (key, table.weight.detach().clone())
+                for key, table in self.tables.items()
+            )
+            for embedding_name, (key, start, size) in self.slices.items():
+                if embedding_name not in saved_rows:
+                    missing_keys.append(prefix + embedding_name + ".weight")
+                    continue
+                rows = saved_rows[embedding_name]
+                shape = torch.Size([size, self.tables[key].embedding_dim])
+                if rows.shape != shape:
+                    error_msgs.append(
+                        "size mismatch for {}{}: copying rows with shape {}, the shape "
+                        "in current model is {}.".format(
+                            prefix, embedding_name, rows.shape, shape
+                        )
+                    )
+                    continue
+                weights[key][start : start + size] = rows
+            for key, weight in weights.items():
+                state_dict[prefix + "tables." + key + ".weight"] = weight
+        super(EmbeddingMatrix, self)._load_from_state_dict(
+            state_dict,
+            prefix,
+            local_metadata,
+            strict,
+            missing_keys,
+            unexpected_keys,
+            error_msgs,
+        )
+
+
 def create_embedding_matrix(
     feature_columns, init_std=0.0001, linear=False, sparse=False, device="cpu"
-) -> nn.ModuleDict:
-    # Return nn.ModuleDict: for sparse features, {embedding_name: nn.Embedding}
-    # for varlen sparse features, {embedding_name: nn.EmbeddingBag}
+) -> EmbeddingMatrix:
+    # Return EmbeddingMatrix: {embedding_name: EmbeddingSlice}, the slices of features
+    # with the same embedding dim share one nn.Embedding
     sparse_feature_columns = (
         list(filter(lambda x: isinstance(x, SparseFeat), feature_columns))
         if len(feature_columns)
@@ -201,25 +341,123 @@ def create_embedding_matrix(
         else []
     )
 
-    embedding_dict = nn.ModuleDict(
-        {
-            feat.embedding_name: nn.Embedding(
-                feat.vocabulary_size,
-                feat.embedding_dim if not linear else 1,
-                sparse=sparse,
-            )
-            for feat in sparse_feature_columns + varlen_sparse_feature_columns
-        }
-    )
+    features = OrderedDict()
+    for feat in sparse_feature_columns + varlen_sparse_feature_columns:
+        features[feat.embedding_name] = feat
+
+    # {embedding_name: (table key, start, size)}, {table key: total vocabulary size}
+    slices, table_sizes = OrderedDict(), OrderedDict()
+    for embedding_name, feat in features.items():
+        key = str(feat.embedding_dim if not linear else 1)
+        start = table_sizes.get(key, 0)
+        slices[embedding_name] = (key, start, feat.vocabulary_size)
+        table_sizes[key] = start + feat.vocabulary_size
+
+    tables = OrderedDict()
+    for key, size in table_sizes.items():
+        tables[key] = nn.Embedding(size, int(key), sparse=sparse)
+        nn.init.normal_(tables[key].weight, mean=0, std=init_std)
 
-    # for feat in varlen_sparse_feature_columns:
-    #     embedding_dict[feat.embedding_name] = nn.EmbeddingBag(
-    #         feat.dimension, embedding_size, sparse=sparse, mode=feat.combiner)
+    return EmbeddingMatrix(tables, slices).to(device)
 
-    for tensor in embedding_dict.values():
-        nn.init.normal_(tensor.weight, mean=0, std=init_std)
 
-    return embedding_dict.to(device)
+def _embedding_table(embedding):
+    # Return (nn.Embedding, row offset, vocabulary size) backing an entry of the
+    # embedding dict
+    if isinstance(embedding, EmbeddingSlice):
+        return embedding.table, embedding.start, embedding.num_embeddings
+    return embedding, 0, embedding.num_embeddings
+
+
+def _get_lookup_plan(
+    X, embedding_dict, input_dict, feature_columns, return_feat_list=(), by_group=False
+):
+    # The column layout of ``X`` is fixed once the feature columns are built, so the
+    # gather indices are computed once and cached on the embedding dict.
+    plans = getattr(embedding_dict, "_lookup_plans", None)
+    if plans is None:
+        plans = embedding_dict._lookup_plans = {}
+    key = (
+        tuple(fc.name for fc in feature_columns),
+        tuple(return_feat_list),
+        by_group,
+        X.device,
+    )
+    plan = plans.get(key)
+    if plan is None:
+        columns = [
+            fc
+            for fc in feature_columns
+            if len(return_feat_list) == 0 or fc.name in return_feat_list
+        ]
+        # with by_group, features ordered by group and {group_name: (start, end)}
+        # into that order
+        group_slices = None
+        if by_group:
+            group_columns = OrderedDict()
+            for fc in columns:
+                group_columns.setdefault(fc.group_name, []).append(fc)
+            columns, group_slices = [], OrderedDict()
+            for group_name, group in group_columns.items():
+                group_slices[group_name] = (len(columns), len(columns) + len(group))
+                columns += group
+        # {id(table): (embedding_name, cols, offsets, limits, sizes, positions)} of the
+        # features sharing a table. Only names and index tensors are cached, the
+        # table itself is resolved on every call so DataParallel replicas use theirs.
+        buckets = OrderedDict()
+        for pos, fc in enumerate(columns):
+            start, end = input_dict[fc.name]
+            table, offset, num_embeddings = _embedding_table(
+                embedding_dict[fc.embedding_name]
+            )
+            _, cols, offsets, limits, sizes, positions = buckets.setdefault(
+                id(table), (fc.embedding_name, [], [], [], [], [])
+            )
+            cols.extend(range(start, end))
+            offsets.extend([offset] * (end - start))
+            limits.extend([num_embeddings] * (end - start))
+            sizes.append(end - start)
+            positions.append(pos)
+        plan = plans[key] = (
+            columns,
+            [
+                (
+                    embedding_name,
+                    torch.tensor(cols, dtype=torch.long, device=X.device),
+                    (
+                        torch.tensor(offsets, dtype=torch.long, device=X.device)
+                        if any(offsets)
+                        else None
+                    ),
+                    torch.tensor(limits, dtype=torch.long, device=X.device),
+                    sizes,
+                    positions,
+                )
+                for embedding_name, cols, offsets, limits, sizes, positions in (
+                    buckets.values()
+                )
+            ],
+            group_slices,
+        )
+    return plan
+
+
+def _fused_lookup(X, embedding_dict, plan):
+    # One gather and one embedding call per table, split back into per-feature views
+    columns, buckets, _ = plan
+    check_bounds = getattr(embedding_dict, "check_bounds", False)
+    embs = [None] * len(columns)
+    for embedding_name, cols, offsets, limits, sizes, positions in buckets:
+        table, _, _ = _embedding_table(embedding_dict[embedding_name])
+        input_tensor = X.index_select(1, cols).long()
+        if check_bounds:
+            _check_ids(input_tensor, limits)
+        if offsets is not None:
+            input_tensor = input_tensor + offsets
+        emb = table(input_tensor)
+        for pos, feat_emb in zip(positions, torch.split(emb, sizes, dim=1)):
+            embs[pos] = feat_emb
+    return embs
 
 
 def embedding_lookup(
@@ -234,7 +472,7 @@ def embedding_lookup(
     """
     Args:
         X: input Tensor [batch_size x hidden_dim]
-        sparse_embedding_dict: nn.ModuleDict, {embedding_name: nn.Embedding}
+        sparse_embedding_dict: EmbeddingMatrix, {embedding_name: EmbeddingSlice}
         sparse_input_dict: OrderedDict, {feature_name:(start, start+dimension)}
         sparse_feature_columns: list, sparse features
         return_feat_list: list, names of feature to be returned, defualt () -> return all features
@@ -242,41 +480,91 @@ def embedding_lookup(
     Return:
         group_embedding_dict: defaultdict(list)
     """
-    group_embedding_dict = defaultdict(list)
-    for fc in sparse_feature_columns:
-        feature_name = fc.name
-        embedding_name = fc.embedding_name
-        if len(return_feat_list) == 0 or feature_name in return_feat_list:
-            # TODO: add hash function
-            # if fc.use_hash:
-            #     raise NotImplementedError("hash function is not implemented in this version!")
-            lookup_idx = np.array(sparse_input_dict[feature_name])
-            input_tensor = X[:, lookup_idx[0] : lookup_idx[1]].long()
-            emb = sparse_embedding_dict[embedding_name](input_tensor)
-            group_embedding_dict[fc.group_name].append(emb)
+    # TODO: add hash function
+    # if fc.use_hash:
+    #     raise NotImplementedError("hash function is not implemented in this version!")
+    plan = _get_lookup_plan(
+        X,
+        sparse_embedding_dict,
+        sparse_input_dict,
+        sparse_feature_columns,
+        return_feat_list,
+        by_group=True,
+    )
+    embs = _fused_lookup(X, sparse_embedding_dict, plan)
     if to_list:
-        return list(chain.from_iterable(group_embedding_dict.values()))
-    return group_embedding_dict
+        return embs
+    return defaultdict(
+        list, {name: embs[start:end] for name, (start, end) in plan[2].items()}
+    )
+
+
+def embedding_list_lookup(
+    X, sparse_embedding_dict, sparse_input_dict, sparse_feature_columns
+):
+    # [embedding of each feature] in feature column order, unlike
+    # embedding_lookup(..., to_list=True) which chains the groups
+    plan = _get_lookup_plan(
+        X, sparse_embedding_dict, sparse_input_dict, sparse_feature_columns
+    )
+    return _fused_lookup(X, sparse_embedding_dict, plan)
 
 
 def varlen_embedding_lookup(
     X, embedding_dict, sequence_input_dict, varlen_sparse_feature_columns
 ):
-    varlen_embedding_vec_dict = {}
+    # TODO: add hash function
+    # if fc.use_hash:
+    #     lookup_idx = Hash(fc.vocabulary_size, mask_zero=True)(sequence_input_dict[feature_name])
+    plan = _get_lookup_plan(
+        X, embedding_dict, sequence_input_dict, varlen_sparse_feature_columns
+    )
+    return {
+        fc.name: emb for fc, emb in zip(plan[0], _fused_lookup(X, embedding_dict, plan))
+    }
+
+
+def varlen_pooling_lookup(
+    X, embedding_dict, sequence_input_dict, varlen_sparse_feature_columns, device
+):
+    # sum/mean pooling are fused into F.embedding_bag on the shared table, masking the
+    # padded positions through per_sample_weights; max pooling still goes through
+    # varlen_embedding_lookup and SequencePoolingLayer
+    varlen_sparse_embedding_list = []
     for fc in varlen_sparse_feature_columns:
-        feature_name = fc.name
-        embedding_name = fc.embedding_name
-        if fc.use_hash:
-            # lookup_idx = Hash(fc.vocabulary_size, mask_zero=True)(sequence_input_dict[feature_name])
-            # TODO: add hash function
-            lookup_idx = sequence_input_dict[feature_name]
+        if fc.combiner not in ("sum", "mean"):
+            sequence_embed_dict = varlen_embedding_lookup(
+                X, embedding_dict, sequence_input_dict, [fc]
+            )
+            varlen_sparse_embedding_list += get_varlen_pooling_list(
+                sequence_embed_dict, X, sequence_input_dict, [fc], device
+            )
+            continue
+        table, offset, num_embeddings = _embedding_table(
+            embedding_dict[fc.embedding_name]
+        )
+        start, end = sequence_input_dict[fc.name]
+        input_tensor = X[:, start:end].long()
+        if getattr(embedding_dict, "check_bounds", False):
+            _check_ids(input_tensor, num_embeddings)
+        if fc.length_name is None:
+            seq_mask = input_tensor != 0
         else:
-            lookup_idx = sequence_input_dict[feature_name]
-        varlen_embedding_vec_dict[feature_name] = embedding_dict[embedding_name](
-            X[:, lookup_idx[0] : lookup_idx[1]].long()
-        )  # (lookup_idx)
-
-    return varlen_embedding_vec_dict
+            length_start, length_end = sequence_input_dict[fc.length_name]
+            seq_length = X[:, length_start:length_end].long()
+            seq_mask = torch.arange(end - start, device=X.device) < seq_length
+        seq_mask = seq_mask.to(table.weight.dtype)
+        emb = F.embedding_bag(
+            input_tensor + offset,
+            table.weight,
+            mode="sum",
+            sparse=table.sparse,
+            per_sample_weights=seq_mask,
+        )
+        if fc.combiner == "mean":
+            emb = emb / (seq_mask.sum(dim=1, keepdim=True) + 1e-8)
+        varlen_sparse_embedding_list.append(emb.unsqueeze(1))
+    return varlen_sparse_embedding_list
 
 
 def get_dense_input(X, features, feature_columns):
@@ -287,8 +575,8 @@ def get_dense_input(X, features, feature_columns):
     )
     dense_input_list = []
     for fc in dense_feature_columns:
-        lookup_idx = np.array(features[fc.name])
-        input_tensor = X[:, lookup_idx[0] : lookup_idx[1]].float()
+        start, end = features[fc.name]
+        input_tensor = X[:, start:end].float()
         dense_input_list.append(input_tensor)
     return dense_input_list
 
@@ -298,5 +586,5 @@ def maxlen_lookup(X, sparse_input_dict, maxlen_column):
         raise ValueError(
             "please add max length column for VarLenSparseFeat of DIN/DIEN input"
         )
-    lookup_idx = np.array(sparse_input_dict[maxlen_column[0]])
-    return X[:, lookup_idx[0] : lookup_idx[1]].long()
+    start, end = sparse_input_dict[maxlen_column[0]]
+    return X[:, start:end].long()
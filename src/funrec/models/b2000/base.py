@@ -20,8 +20,8 @@ from funrec.inputs import (
     VarLenSparseFeat,
     build_input_features,
     create_embedding_matrix,
-    get_varlen_pooling_list,
-    varlen_embedding_lookup,
+    embedding_list_lookup,
+    varlen_pooling_lookup,
 )
 from funrec.layers import PredictionLayer
 from funrec.layers.utils import slice_arrays
@@ -352,22 +352,13 @@ class BaseModel(nn.Module):
         if not support_dense and len(dense_feature_columns) > 0:
             raise ValueError("DenseFeat is not supported in dnn_feature_columns")
 
-        sparse_embedding_list = [
-            embedding_dict[feat.embedding_name](
-                X[
-                    :,
-                    self.feature_index[feat.name][0] : self.feature_index[feat.name][1],
-                ].long()
-            )
-            for feat in sparse_feature_columns
-        ]
-
-        sequence_embed_dict = varlen_embedding_lookup(
-            X, self.embedding_dict, self.feature_index, varlen_sparse_feature_columns
+        sparse_embedding_list = embedding_list_lookup(
+            X, embedding_dict, self.feature_index, sparse_feature_columns
         )
-        varlen_sparse_embedding_list = get_varlen_pooling_list(
-            sequence_embed_dict,
+
+        varlen_sparse_embedding_list = varlen_pooling_lookup(
             X,
+            self.embedding_dict,
             self.feature_index,
             varlen_sparse_feature_columns,
             self.device,
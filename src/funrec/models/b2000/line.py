@@ -10,8 +10,8 @@ from funrec.inputs import (
     SparseFeat,
     VarLenSparseFeat,
     create_embedding_matrix,
-    get_varlen_pooling_list,
-    varlen_embedding_lookup,
+    embedding_list_lookup,
+    varlen_pooling_lookup,
 )
 
 
@@ -46,8 +46,6 @@ class Linear(nn.Module):
         #              self.sparse_feature_columns}
         #         )
         # .to("cuda:1")
-        for tensor in self.embedding_dict.values():
-            nn.init.normal_(tensor.weight, mean=0, std=init_std)
 
         if len(self.dense_feature_columns) > 0:
             self.weight = nn.Parameter(
@@ -58,32 +56,20 @@ class Linear(nn.Module):
             torch.nn.init.normal_(self.weight, mean=0, std=init_std)
 
     def forward(self, X, sparse_feat_refine_weight=None):
-        sparse_embedding_list = [
-            self.embedding_dict[feat.embedding_name](
-                X[
-                    :,
-                    self.feature_index[feat.name][0] : self.feature_index[feat.name][1],
-                ].long()
-            )
-            for feat in self.sparse_feature_columns
-        ]
+        sparse_embedding_list = embedding_list_lookup(
+            X, self.embedding_dict, self.feature_index, self.sparse_feature_columns
+        )
 
         dense_value_list = [
             X[:, self.feature_index[feat.name][0] : self.feature_index[feat.name][1]]
             for feat in self.dense_feature_columns
         ]
 
-        sequence_embed_dict = varlen_embedding_lookup(
+        varlen_embedding_list = varlen_pooling_lookup(
             X,
             self.embedding_dict,
             self.feature_index,
             self.varlen_sparse_feature_columns,
-        )
-        varlen_embedding_list = get_varlen_pooling_list(
-            sequence_embed_dict,
-            X,
-            self.feature_index,
-            self.varlen_sparse_feature_columns,
             self.device,
         )
 
@@ -12,9 +12,8 @@ from funrec.inputs import (
     VarLenSparseFeat,
     combined_dnn_input,
     embedding_lookup,
-    get_varlen_pooling_list,
     maxlen_lookup,
-    varlen_embedding_lookup,
+    varlen_pooling_lookup,
 )
 from funrec.layers import DNN, AttentionSequencePoolingLayer
 from funrec.models.b2000 import BaseModel
@@ -150,18 +149,11 @@ class DIN(BaseModel):
             to_list=True,
         )
 
-        sequence_embed_dict = varlen_embedding_lookup(
+        sequence_embed_list = varlen_pooling_lookup(
             X,
             self.embedding_dict,
             self.feature_index,
             self.sparse_varlen_feature_columns,
-        )
-
-        sequence_embed_list = get_varlen_pooling_list(
-            sequence_embed_dict,
-            X,
-            self.feature_index,
-            self.sparse_varlen_feature_columns,
             self.device,
         )
 
@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 
 
 from torch.utils.data import Dataset, DataLoader
@@ -9,12 +10,16 @@ import numpy as np
 import os
 import math
 import random
-from sklearn.preprocessing import normalize
 from tqdm import tqdm
 from sklearn.manifold import TSNE
 from matplotlib import pyplot as plt
 from .core import MIND
 
+try:
+    from numba import njit, prange
+except ImportError:  # 没有numba时多兴趣候选合并退回NumPy实现
+    njit, prange = None, range
+
 
 class SeqnenceDataset(Dataset):
     def __init__(self, config, df, phase="train"):
@@ -22,68 +27,58 @@ class SeqnenceDataset(Dataset):
         self.df = df
         self.max_length = self.config["max_length"]
         self.df = self.df.sort_values(by=["user_id", "timestamp"])
-        self.user2item = self.df.groupby("user_id")["item_id"].apply(list).to_dict()
-        self.user_list = self.df["user_id"].unique()
         self.phase = phase
 
+        # 排序后每个用户的物品是连续的一段，由起始位置和长度切分，不经过groupby
+        self.user_list, starts, self.lengths = np.unique(
+            self.df["user_id"].values, return_index=True, return_counts=True
+        )
+        item_ids = self.df["item_id"].values.astype(np.int64)
+        # 每个用户的物品序列预先补齐成一个int64矩阵，items[u, :lengths[u]]
+        user_index = np.repeat(np.arange(len(self.user_list)), self.lengths)
+        positions = np.arange(len(item_ids)) - np.repeat(starts, self.lengths)
+        self.items = np.zeros((len(self.user_list), self.lengths.max()), dtype=np.int64)
+        self.items[user_index, positions] = item_ids
+        # 测试时每个用户前80%的物品作为历史，其余作为ground truth
+        self.split_k = (self.lengths * 0.8).astype(np.int64)
+        self.test_gd = None
+
     def __len__(
         self,
     ):
-        return len(self.user2item)
+        return len(self.user_list)
+
+    def _get_hist(self, index, k):
+        # 取第k个物品之前的max_length个物品，不足的补0
+        start = max(0, k - self.max_length)
+        hist_item = np.zeros(self.max_length, dtype=np.int64)
+        hist_mask = np.zeros(self.max_length, dtype=np.float32)
+        hist_item[: k - start] = self.items[index, start:k]
+        hist_mask[: k - start] = 1.0
+        return torch.from_numpy(hist_item), torch.from_numpy(hist_mask)
 
     def __getitem__(self, index):
+        length = self.lengths[index]
         if self.phase == "train":
-            user_id = self.user_list[index]
-            item_list = self.user2item[user_id]
-            hist_item_list = []
-            hist_mask_list = []
-
-            k = random.choice(
-                range(4, len(item_list))
-            )  # 从[8,len(item_list))中随机选择一个index
+            k = random.randrange(4, length)  # 从[4,len(item_list))中随机选择一个index
             # k = np.random.randint(2,len(item_list))
-            item_id = item_list[k]  # 该index对应的item加入item_id_list
-
-            if k >= self.max_length:  # 选取seq_len个物品
-                hist_item_list.append(item_list[k - self.max_length : k])
-                hist_mask_list.append([1.0] * self.max_length)
-            else:
-                hist_item_list.append(item_list[:k] + [0] * (self.max_length - k))
-                hist_mask_list.append([1.0] * k + [0.0] * (self.max_length - k))
-
-            return (
-                torch.Tensor(hist_item_list).squeeze(0),
-                torch.Tensor(hist_mask_list).squeeze(0),
-                torch.Tensor([item_id]),
-            )
+            item_id = self.items[index, k]  # 该index对应的item加入item_id_list
+            hist_item, hist_mask = self._get_hist(index, k)
+            return hist_item, hist_mask, torch.as_tensor([item_id], dtype=torch.long)
         else:
-            user_id = self.user_list[index]
-            item_list = self.user2item[user_id]
-            hist_item_list = []
-            hist_mask_list = []
-
-            k = int(0.8 * len(item_list))
+            k = self.split_k[index]
             # k = len(item_list)-1
-
-            if k >= self.max_length:  # 选取seq_len个物品
-                hist_item_list.append(item_list[k - self.max_length : k])
-                hist_mask_list.append([1.0] * self.max_length)
-            else:
-                hist_item_list.append(item_list[:k] + [0] * (self.max_length - k))
-                hist_mask_list.append([1.0] * k + [0.0] * (self.max_length - k))
-
-            return (
-                torch.Tensor(hist_item_list).squeeze(0),
-                torch.Tensor(hist_mask_list).squeeze(0),
-                item_list[k:],
-            )
+            hist_item, hist_mask = self._get_hist(index, k)
+            return hist_item, hist_mask, self.items[index, k:length].tolist()
 
     def get_test_gd(self):
-        self.test_gd = {}
-        for user in self.user2item:
-            item_list = self.user2item[user]
-            test_item_index = int(0.8 * len(item_list))
-            self.test_gd[user] = item_list[test_item_index:]
+        if self.test_gd is None:
+            self.test_gd = {
+                user: self.items[
+                    index, self.split_k[index] : self.lengths[index]
+                ].tolist()
+                for index, user in enumerate(self.user_list)
+            }
         return self.test_gd
 
 
@@ -103,14 +98,8 @@ config = {
 
 
 def my_collate(batch):
-    hist_item, hist_mask, item_list = list(zip(*batch))
-
-    hist_item = [x.unsqueeze(0) for x in hist_item]
-    hist_mask = [x.unsqueeze(0) for x in hist_mask]
-
-    hist_item = torch.cat(hist_item, axis=0)
-    hist_mask = torch.cat(hist_mask, axis=0)
-    return hist_item, hist_mask, item_list
+    hist_item, hist_mask, item_list = zip(*batch)
+    return torch.stack(hist_item, 0), torch.stack(hist_mask, 0), list(item_list)
 
 
 def save_model(model, path):
@@ -131,100 +120,169 @@ note: 基于faiss的向量召回
 """
 
 
-def get_predict(model, test_data, hidden_size, topN=20):
-    import faiss
-
-    item_embs = model.output_items().cpu().detach().numpy()
-    item_embs = normalize(item_embs, norm="l2")
-    gpu_index = faiss.IndexFlatIP(hidden_size)
-    gpu_index.add(item_embs)
+def _dedupe_topn(I, D, topN, out, lengths):
+    # 逐用户并行：按内积降序遍历候选，跳过id为0和已选过的物品，选满topN个为止
+    for b in prange(I.shape[0]):
+        order = np.argsort(-D[b], kind="mergesort")
+        c = 0
+        for j in order:
+            item_id = I[b, j]
+            if item_id == 0:
+                continue
+            duplicated = False
+            for t in range(c):
+                if out[b, t] == item_id:
+                    duplicated = True
+                    break
+            if duplicated:
+                continue
+            out[b, c] = item_id
+            c += 1
+            if c == topN:
+                break
+        lengths[b] = c
+
+
+if njit is not None:
+    _dedupe_topn = njit(parallel=True)(_dedupe_topn)
+
+
+def merge_interest_topn(I, D, ni, topN, chunk_size=1024):
+    """将每个用户num_interest个兴趣向量的topN近邻物品（num_interest*topN个物品）按内积降序合并，
+    去重并跳过id为0的物品后取前topN个，返回每个用户的物品数组列表
+    """
+    # shape=(batch_size, num_interest*topN)
+    I = np.reshape(I, [-1, ni * topN])
+    D = np.reshape(D, [-1, ni * topN])
+    if njit is not None:
+        out = np.zeros((I.shape[0], topN), dtype=I.dtype)
+        lengths = np.zeros(I.shape[0], dtype=np.int64)
+        _dedupe_topn(I, D, topN, out, lengths)
+        return [item_list[:n] for item_list, n in zip(out, lengths)]
+    # 降序排序，内积越大，向量越近
+    order = np.argsort(-D, axis=1, kind="stable")
+    I = np.take_along_axis(I, order, axis=1)
+    earlier = np.tri(I.shape[1], k=-1, dtype=bool)
+    merged = []
+    # 两两比较的掩码大小为chunk_size*(num_interest*topN)^2，按用户分块计算以限制内存
+    for begin in range(0, I.shape[0], chunk_size):
+        chunk = I[begin : begin + chunk_size]
+        # 与排在前面的物品重复的位置
+        duplicated = ((chunk[:, :, None] == chunk[:, None, :]) & earlier).any(axis=2)
+        keep = ~duplicated & (chunk != 0)
+        # 按距离由近到远，最后选出最近的topN个物品作为最终的推荐物品
+        keep &= np.cumsum(keep, axis=1) <= topN
+        merged += [item_list[row_keep] for item_list, row_keep in zip(chunk, keep)]
+    return merged
+
+
+def inference_autocast(model):
+    # 评估只做前向，CUDA上用bf16计算以减少访存，CPU上保持float32
+    device_type = next(model.parameters()).device.type
+    return torch.autocast(
+        device_type, dtype=torch.bfloat16, enabled=device_type == "cuda"
+    )
 
-    test_gd = dict()
-    preds = dict()
 
-    user_id = 0
+def build_item_index(item_embs, hidden_size, ivf_threshold=50000, nprobe=8):
+    import faiss
 
+    n_items = item_embs.shape[0]
+    if n_items < ivf_threshold:
+        index = faiss.IndexFlatIP(hidden_size)
+    else:
+        # 物品较多时用倒排索引代替暴力内积搜索，nlist取sqrt(n_items)
+        quantizer = faiss.IndexFlatIP(hidden_size)
+        index = faiss.IndexIVFFlat(
+            quantizer,
+            hidden_size,
+            int(math.sqrt(n_items)),
+            faiss.METRIC_INNER_PRODUCT,
+        )
+        index.train(item_embs)
+        index.nprobe = nprobe
+    if hasattr(faiss, "StandardGpuResources") and faiss.get_num_gpus() > 0:
+        # 物品向量在评估过程中不变，只在GPU上建一次索引
+        res = faiss.StandardGpuResources()
+        index = faiss.index_cpu_to_gpu(res, 0, index)
+    index.add(item_embs)
+    return index
+
+
+@torch.inference_mode()
+def get_predict(model, test_data, hidden_size, topN=20, ivf_threshold=50000, nprobe=8):
+    item_embs = model.output_items()
+    # 与用户向量一样在模型所在设备上以float32做L2归一化
+    item_embs = F.normalize(item_embs.float(), dim=1)
+    item_embs = item_embs.detach().cpu().numpy().astype("float32", copy=False)
+    index = build_item_index(item_embs, hidden_size, ivf_threshold, nprobe)
+
+    all_user_embs = []
+    all_targets = []
+    ni = 0  # num_interest，非多兴趣模型为0
     for item_seq, mask, targets in tqdm(test_data):
         # 获取用户嵌入
         # 多兴趣模型，shape=(batch_size, num_interest, embedding_dim)
         # 其他模型，shape=(batch_size, embedding_dim)
-        user_embs = model(item_seq, mask, None, train=False)["user_emb"]
-        user_embs = user_embs.cpu().detach().numpy()
-
-        # 用内积来近邻搜索，实际是内积的值越大，向量越近（越相似）
-        if len(user_embs.shape) == 2:  # 非多兴趣模型评估
-            user_embs = normalize(user_embs, norm="l2").astype("float32")
-            D, I = gpu_index.search(
-                user_embs, topN
-            )  # Inner Product近邻搜索，D为distance，I是index
-            #             D,I = faiss.knn(user_embs, item_embs, topN,metric=faiss.METRIC_INNER_PRODUCT)
-            for i, iid_list in enumerate(
-                targets
-            ):  # 每个用户的label列表，此处item_id为一个二维list，验证和测试是多label的
-                test_gd[user_id] = iid_list
-                preds[user_id] = I[i, :]
-                user_id += 1
-        else:  # 多兴趣模型评估
-            ni = user_embs.shape[1]  # num_interest
-            user_embs = np.reshape(
-                user_embs, [-1, user_embs.shape[-1]]
-            )  # shape=(batch_size*num_interest, embedding_dim)
-            user_embs = normalize(user_embs, norm="l2").astype("float32")
-            # Inner Product近邻搜索，D为distance，I是index
-            D, I = gpu_index.search(user_embs, topN)
-            #             D,I = faiss.knn(user_embs, item_embs, topN,metric=faiss.METRIC_INNER_PRODUCT)
-
-            # 每个用户的label列表，此处item_id为一个二维list，验证和测试是多label的
-            for i, iid_list in enumerate(targets):
-                recall = 0
-                dcg = 0.0
-                item_list_set = []
-
-                # 将num_interest个兴趣向量的所有topN近邻物品（num_interest*topN个物品）集合起来按照距离重新排序
-                item_list = list(
-                    zip(
-                        np.reshape(I[i * ni : (i + 1) * ni], -1),
-                        np.reshape(D[i * ni : (i + 1) * ni], -1),
-                    )
-                )
-                # 降序排序，内积越大，向量越近
-                item_list.sort(key=lambda x: x[1], reverse=True)
-                # 按距离由近到远遍历推荐物品列表，最后选出最近的topN个物品作为最终的推荐物品
-                for j in range(len(item_list)):
-                    if item_list[j][0] not in item_list_set and item_list[j][0] != 0:
-                        item_list_set.append(item_list[j][0])
-                        if len(item_list_set) >= topN:
-                            break
-                test_gd[user_id] = iid_list
-                preds[user_id] = item_list_set
-                user_id += 1
+        with inference_autocast(model):
+            user_embs = model(item_seq, mask, None, train=False)["user_emb"]
+        if user_embs.dim() == 3:  # 多兴趣模型评估
+            ni = user_embs.shape[1]
+        # 在模型所在设备上以float32做L2归一化，只拷贝一次到CPU
+        user_embs = F.normalize(
+            user_embs.float().reshape(-1, user_embs.shape[-1]), dim=-1
+        )  # shape=(batch_size*num_interest, embedding_dim)
+        user_embs = user_embs.detach().cpu().numpy().astype("float32", copy=False)
+        all_user_embs.append(user_embs)
+        # 每个用户的label列表，此处item_id为一个二维list，验证和测试是多label的
+        all_targets.extend(targets)
+
+    # 用内积来近邻搜索，实际是内积的值越大，向量越近（越相似）
+    # 所有用户只做一次搜索，D为distance，I是index
+    D, I = index.search(np.concatenate(all_user_embs), topN)
+    # D,I = faiss.knn(user_embs, item_embs, topN,metric=faiss.METRIC_INNER_PRODUCT)
+
+    if ni == 0:  # 非多兴趣模型评估
+        preds = dict(enumerate(I))
+    else:  # 多兴趣模型评估
+        preds = dict(enumerate(merge_interest_topn(I, D, ni, topN)))
+    test_gd = dict(enumerate(all_targets))
     return test_gd, preds
 
 
 def evaluate(preds, test_gd, topN=50):
-    total_recall = 0.0
-    total_ndcg = 0.0
-    total_hitrate = 0
-    for user in test_gd.keys():
-        recall = 0
-        dcg = 0.0
-        item_list = test_gd[user]
-        for no, item_id in enumerate(item_list):
-            if item_id in preds[user][:topN]:
-                recall += 1
-                dcg += 1.0 / math.log(no + 2, 2)
-            idcg = 0.0
-            for no in range(recall):
-                idcg += 1.0 / math.log(no + 2, 2)
-        total_recall += recall * 1.0 / len(item_list)
-        if recall > 0:
-            total_ndcg += dcg / idcg
-            total_hitrate += 1
+    users = list(test_gd.keys())
+    gt_items = [np.asarray(test_gd[user], dtype=np.int64) for user in users]
+    pred_items = [np.asarray(preds[user][:topN], dtype=np.int64) for user in users]
+    gt_lens = np.array([len(x) for x in gt_items])
+    pred_lens = np.array([len(x) for x in pred_items])
+    gt_items = np.concatenate(gt_items)
+    pred_items = np.concatenate(pred_items)
+
+    # 把(用户, 物品)编码成一个整数，一次isin判断每个用户的真实物品是否在其topN推荐中
+    # 物品id加1，faiss结果不足topN时返回的-1也能编码
+    base = max(gt_items.max(initial=0), pred_items.max(initial=0)) + 2
+    gt_rows = np.repeat(np.arange(len(users)), gt_lens)
+    pred_rows = np.repeat(np.arange(len(users)), pred_lens)
+    hits = np.isin(gt_rows * base + gt_items + 1, pred_rows * base + pred_items + 1)
+
+    # 命中的物品按其在真实列表中的位置no累加1/log2(no+2)
+    discount = 1.0 / np.log2(np.arange(gt_lens.max(initial=0)) + 2)
+    no = np.arange(len(gt_items)) - np.repeat(np.cumsum(gt_lens) - gt_lens, gt_lens)
+    recall = np.bincount(gt_rows, weights=hits, minlength=len(users))
+    dcg = np.bincount(gt_rows, weights=hits * discount[no], minlength=len(users))
+    hit = recall > 0
+    idcg = np.cumsum(discount)[recall[hit].astype(np.int64) - 1]
+
     total = len(test_gd)
-    recall = total_recall / total
-    ndcg = total_ndcg / total
-    hitrate = total_hitrate * 1.0 / total
-    return {f"recall@{topN}": recall, f"ndcg@{topN}": ndcg, f"hitrate@{topN}": hitrate}
+    recall = np.sum(recall / gt_lens) / total
+    ndcg = np.sum(dcg[hit] / idcg) / total
+    hitrate = np.sum(hit) * 1.0 / total
+    return {
+        f"recall@{topN}": float(recall),
+        f"ndcg@{topN}": float(ndcg),
+        f"hitrate@{topN}": float(hitrate),
+    }
 
 
 # 指标计算
@@ -241,7 +299,13 @@ train_dataset = SeqnenceDataset(config, train_df, phase="train")
 valid_dataset = SeqnenceDataset(config, valid_df, phase="test")
 test_dataset = SeqnenceDataset(config, test_df, phase="test")
 train_loader = DataLoader(
-    dataset=train_dataset, batch_size=config["batch_size"], shuffle=True, num_workers=8
+    dataset=train_dataset,
+    batch_size=config["batch_size"],
+    shuffle=True,
+    num_workers=8,
+    pin_memory=torch.cuda.is_available(),
+    persistent_workers=True,
+    prefetch_factor=4,
 )
 valid_loader = DataLoader(
     dataset=valid_dataset,
@@ -261,7 +325,7 @@ model = MIND(config)
 # model = SRGNN(config)
 optimizer = torch.optim.Adam(params=model.parameters(), lr=config["lr"])
 # optimizer = torch.optimizer.Adam(parameters=model.parameters(), learning_rate=config['lr'])
-log_df = pd.DataFrame()
+log_rows = []
 best_reacall = -1
 
 exp_path = "./ml-20m_softmax/MIND_{}_{}_{}/".format(
@@ -304,8 +368,8 @@ for epoch in range(1, 1 + config["Epoch"]):
     )
     print(recall_metric)
     recall_metric["phase"] = "valid"
-    log_df = log_df.append(recall_metric, ignore_index=True)
-    log_df.to_csv(log_csv)
+    log_rows.append(recall_metric)
+    pd.DataFrame(log_rows).to_csv(log_csv)
 
     if recall_metric["recall@50"] > best_reacall:
         save_model(model, exp_path)
@@ -320,8 +384,8 @@ model = load_model(model, exp_path)
 recall_metric = evaluate_model(model, test_loader, config["embedding_dim"], topN=50)
 print(recall_metric)
 recall_metric["phase"] = "test"
-log_df = log_df.append(recall_metric, ignore_index=True)
-log_df.to_csv(log_csv)
+log_rows.append(recall_metric)
+pd.DataFrame(log_rows).to_csv(log_csv)
 
 
 # embedding分布可视化